@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+
+
+class DriverConfig(AppConfig):
+    name = 'driver'
+
+    def ready(self):
+        from .views import connect_group_signals
+        connect_group_signals()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from flask import current_app as app, abort, safe_join, send_file
+from pymongo.errors import DuplicateKeyError
+
+from storage import db, category_as_csv, category_images_as_zip
+
+
+EXPORTS = {
+    'csv': (category_as_csv, '{}.csv', 'text/csv'),
+    'images': (category_images_as_zip, '{}-images.zip', 'application/zip'),
+}
+
+
+def covering_categories(category_node):
+    """The category and its ancestors: a scrape of any of them covers the category subtree"""
+    category_ids = [category_node]
+    category = db.categories.find_one({'_id': category_node})
+    if category:
+        category_ids += [c for c in category.get('path', '').split(',') if c]
+    return category_ids
+
+
+def active_job(category_ids):
+    """An unfinished job for one of categories, jobs older than SCRAPE_JOB_TIMEOUT are considered dead"""
+    started_after = ObjectId.from_datetime(datetime.utcnow() - app.config['SCRAPE_JOB_TIMEOUT'])
+    return db.jobs.find_one({'category': {'$in': category_ids},
+                             'status': {'$ne': 'finished'},
+                             '_id': {'$gt': started_after}})
+
+
+def is_queued(request):
+    """A scrape request blocks duplicates until tasks.scrape writes its job or SCRAPE_QUEUE_TIMEOUT passes"""
+    if request['created'] <= datetime.utcnow() - app.config['SCRAPE_QUEUE_TIMEOUT']:
+        return False
+    job_created_after = ObjectId.from_datetime(request['created'])
+    return not db.jobs.find_one({'category': request['_id'], '_id': {'$gte': job_created_after}})
+
+
+def claim_scrape_request(category_node):
+    """Atomically marks the category as queued, returns False if another request has done it"""
+    request = db.scrape_requests.find_one({'_id': category_node})
+    if request is None:
+        try:
+            db.scrape_requests.insert({'_id': category_node, 'created': datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    if is_queued(request):
+        return False
+
+    # compare-and-swap on the value read above: only one of concurrent requests updates it
+    result = db.scrape_requests.update({'_id': category_node, 'created': request['created']},
+                                       {'$set': {'created': datetime.utcnow()}})
+    return result['n'] == 1
+
+
+def coalesce_scrape(category_node):
+    """Returns id of a job or of a queued scrape which covers the category.
+
+    Returns None if there is none, the category is claimed then
+    and the caller must queue the scrape.
+    """
+    category_ids = covering_categories(category_node)
+
+    job = active_job(category_ids)
+    if job:
+        return str(job['_id'])
+
+    for request in db.scrape_requests.find({'_id': {'$in': category_ids[1:]}}):
+        if is_queued(request):
+            return request['_id']
+
+    if not claim_scrape_request(category_node):
+        return category_node
+
+
+def export_version(category):
+    """Identifies the finished scrape jobs which affect the category export.
+
+    A job for the category, for any of its ancestors or descendants
+    may change the exported products.
+    """
+    category_ids = [category['_id']] + [c for c in category.get('path', '').split(',') if c]
+    descendant_categories = db.categories.find({'path': {'$regex': '^{c[path]}{c[_id]},'.format(c=category)}},
+                                               {'_id': 1})
+    category_ids += [c['_id'] for c in descendant_categories]
+
+    jobs = db.jobs.find({'category': {'$in': category_ids}, 'status': 'finished'}, {'_id': 1})
+    job_ids = ','.join(sorted(str(j['_id']) for j in jobs))
+    return hashlib.md5(job_ids.encode('utf-8')).hexdigest()[:12]
+
+
+def export_versions(folder, suffix):
+    if not os.path.exists(folder):
+        return []
+    return sorted(n for n in os.listdir(folder) if n.endswith(suffix))
+
+
+def stored_export(folder, suffix, version):
+    versions = export_versions(folder, suffix)
+    if versions and versions[-1][:-len(suffix)].split('-')[-1] == version:
+        return os.path.join(folder, versions[-1])
+
+
+def prune_exports(folder, suffix):
+    """Removes the versions which were superseded more than EXPORT_GRACE ago.
+
+    A request may resolve a version right before a newer one is stored,
+    the grace period lets it open the file. An opened file survives removal.
+    """
+    superseded_before = time.time() - app.config['EXPORT_GRACE'].total_seconds()
+    versions = export_versions(folder, suffix)
+    for name, newer in zip(versions, versions[1:]):
+        if os.path.getmtime(os.path.join(folder, newer)) < superseded_before:
+            os.remove(os.path.join(folder, name))
+
+
+def build_export(category, kind, version=None):
+    """Stores a new version of the export artifact and returns its path"""
+    cid = category['_id']
+    build, filename, _ = EXPORTS[kind]
+    folder = safe_join(app.config['EXPORT_DIR'], cid)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    if version is None:
+        version = export_version(category)
+    path = os.path.join(folder, '{}-{}.{}'.format(int(time.time() * 1000), version, filename.format(cid)))
+    data = build(cid, tempfile.TemporaryFile())
+    with open(path + '.part', 'wb') as f:
+        if hasattr(data, 'read'):
+            shutil.copyfileobj(data, f)
+        else:
+            for chunk in data:
+                f.write(chunk)
+    os.rename(path + '.part', path)
+
+    prune_exports(folder, '.' + filename.format(cid))
+    return path
+
+
+def latest_export(category, kind):
+    """Returns the stored artifact, rebuilds it if a scrape job has finished since.
+
+    Concurrent requests for a stale export wait for a single build.
+    """
+    cid = category['_id']
+    _, filename, _ = EXPORTS[kind]
+    folder = safe_join(app.config['EXPORT_DIR'], cid)
+    suffix = '.' + filename.format(cid)
+    version = export_version(category)
+    path = stored_export(folder, suffix, version)
+    if path:
+        return path
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(os.path.join(folder, '.{}.lock'.format(kind)), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return stored_export(folder, suffix, version) or build_export(category, kind, version)
+
+
+def export_response(cid, kind):
+    # safe_join raises NotFound for ids like '..' before the category lookup
+    safe_join(app.config['EXPORT_DIR'], cid)
+    category = db.categories.find_one({'_id': cid})
+    if not category:
+        abort(404)
+
+    _, filename, mimetype = EXPORTS[kind]
+    # conditional=True gives us ETag/Last-Modified and Range support
+    return send_file(latest_export(category, kind),
+                     mimetype=mimetype,
+                     as_attachment=True,
+                     attachment_filename=filename.format(cid),
+                     conditional=True)
@@ -1,14 +1,21 @@
 from __future__ import absolute_import
+import base64
+import hashlib
 import logging
 import os
 from os.path import join, basename, splitext
-from urlparse import urljoin
+from urllib import unquote
+from urlparse import urljoin, urlparse
 import zipfile
 from lxml import etree
 from twisted.internet import defer, reactor, threads
+from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.persisted import dirdbm
 from twisted.python import log
 from twisted.python.failure import Failure
+from twisted.web.client import (Agent, ProxyAgent, BrowserLikeRedirectAgent, ContentDecoderAgent,
+                                GzipDecoder, readBody)
+from twisted.web.http_headers import Headers
 from eronet import Map, Album
 from eronet.twisted import get_page, download_page
 from eronet.utils import get_query, zip_index, zip_date, strip, first
@@ -26,7 +33,9 @@ class PageSpider(object):
         self.dbm = dirdbm.Shelf(settings['dbm_dir'])
         self.delay = settings['download_delay']
         self.user_agent = settings['user_agent']
+        self.connect_timeout = settings.get('connect_timeout', 30)
         self.albums = []
+        self.validators = {}
 
     def start(self):
         """Starts crawling self.start_url
@@ -35,6 +44,7 @@ class PageSpider(object):
             New albums that should be downloaded (as Deferred)
         """
         self.albums = []
+        self.validators = {}
         self.finished = defer.Deferred()
         self.download_page(self.start_url)
         return self.finished
@@ -44,13 +54,84 @@ class PageSpider(object):
             log.err(failure)
             self.finished.callback(self.albums)
 
-        #d = getPage(url)
-        d = get_page(url, self.proxy_url, agent=self.user_agent)
-        d.addCallback(self.parse_page, url)
-        d.addCallback(self.collect_albums)
-        d.addCallback(self.download_next_page)
+        if url == self.start_url:
+            d = self.conditional_get(url)
+            d.addCallback(self.process_start_page, url)
+        else:
+            #d = getPage(url)
+            d = get_page(url, self.proxy_url, agent=self.user_agent)
+            d.addCallback(self.process_page, url)
         d.addErrback(on_error)
 
+    def conditional_get(self, url):
+        """Requests url with validators stored by remember_page.
+
+        Returns:
+            (html, validators) or None if the page is not modified (as Deferred)
+        """
+        headers = Headers({'User-Agent': [self.user_agent]})
+        if self.proxy_url and urlparse(self.proxy_url).username:
+            headers.addRawHeader('Proxy-Authorization', self.proxy_authorization())
+        stored = self.dbm.get(self.page_key(url), {})
+        if stored.get('etag'):
+            headers.addRawHeader('If-None-Match', stored['etag'])
+        if stored.get('last_modified'):
+            headers.addRawHeader('If-Modified-Since', stored['last_modified'])
+
+        def on_response(response):
+            if response.code == 304:
+                return None
+            if response.code != 200:
+                raise Exception("Can't download {0}: HTTP {1}".format(url, response.code))
+
+            validators = {
+                'etag': first(response.headers.getRawHeaders('etag', [])),
+                'last_modified': first(response.headers.getRawHeaders('last-modified', [])),
+            }
+            d = readBody(response)
+            d.addCallback(lambda html: (html, validators))
+            return d
+
+        d = self.http_agent().request('GET', url, headers)
+        d.addCallback(on_response)
+        return d
+
+    def http_agent(self):
+        """Follows redirects and decodes gzip like get_page does"""
+        if self.proxy_url:
+            proxy = urlparse(self.proxy_url)
+            agent = ProxyAgent(TCP4ClientEndpoint(reactor, proxy.hostname, proxy.port or 80,
+                                                  timeout=self.connect_timeout))
+        else:
+            agent = Agent(reactor, connectTimeout=self.connect_timeout)
+        return ContentDecoderAgent(BrowserLikeRedirectAgent(agent), [('gzip', GzipDecoder)])
+
+    def proxy_authorization(self):
+        proxy = urlparse(self.proxy_url)
+        credentials = '{0}:{1}'.format(unquote(proxy.username), unquote(proxy.password or ''))
+        return 'Basic ' + base64.b64encode(credentials)
+
+    def process_start_page(self, result, url):
+        if result is None:
+            logger.info('%s is not modified since the last crawl', url)
+            self.finished.callback(self.albums)
+            return
+
+        html, self.validators = result
+        self.process_page(html, url)
+
+    def process_page(self, html, url):
+        page_data = self.parse_page(html, url)
+        self.collect_albums(page_data)
+        self.download_next_page(page_data)
+
+    def page_key(self, url):
+        return 'page_' + hashlib.sha1(url).hexdigest()
+
+    def remember_page(self, url):
+        if any(self.validators.values()):
+            self.dbm[self.page_key(url)] = self.validators
+
     def parse_page(self, html, url):
         """Returns not downloaded albums and next page url"""
 
@@ -77,6 +158,10 @@ class PageSpider(object):
                 else:
                     logger.warning("Album not valid: %s", album)
 
+        # only a page with everything downloaded may be skipped on 304 next time
+        if url == self.start_url and not zip_urls_to_download:
+            self.remember_page(url)
+
         next_page_url = None
         if set(all_zip_urls) == set(zip_urls_to_download):
             link = doc.xpath('//a[starts-with(text(), "NEXT")]/@href')
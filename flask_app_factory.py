@@ -1,16 +1,23 @@
+import atexit
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 from pathlib import Path
 
 import connexion
+from celery.signals import worker_process_init
+from flask import g, jsonify
 from flask_login import login_required
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from webassets.loaders import PythonLoader as PythonAssetsLoader
 
 from app.controllers.admin.context_processors import users_helpers
 from app.controllers.admin.views import admin_bp, auth_bp
 from app.utils import ContextualFilter, SaferProxyFix
 from app.utils.gateways import register_senders
+from flask_app_utils import (RequestMetrics, remember_endpoint, count_query,
+                             JSONFormatter, DroppingQueueHandler, send_task_batches)
 
 from . import assets
 from .extensions import cache, jsglue, login_manager, mail, db, cors, assets as assets_env, celery
@@ -21,23 +28,33 @@ from .views import site_map, share
 from .response import Error
 
 
-def create_app(config=None, config_overrides=None):
+def create_app(config=None, config_overrides=None, http=True):
+    """
+    Application factory.
+    Pass http=False for processes which serve no HTTP (e.g. Celery workers):
+    the API spec, the proxy fix and request metrics are skipped then.
+    Blueprints, extensions and context processors stay for url_for and templates in tasks.
+    """
     # connexion app (wrapper)
     k24 = connexion.App('app', specification_dir='../swagger/')
-    k24.add_api('api.yaml')
+    if http:
+        k24.add_api('api.yaml')
 
     # flask app
     app = k24.app
     app.static_folder = '../static'
     configure_app(app, config, config_overrides)
 
-    app.wsgi_app = SaferProxyFix(app.wsgi_app)
+    if http:
+        app.wsgi_app = SaferProxyFix(app.wsgi_app)
 
     register_extensions(app)
     register_handlers(app)
     register_blueprints(app)
     register_views(app)
     register_context_processors(app)
+    if http:
+        register_metrics(app)
 
     configure_celery(app)
     configure_logging(app)
@@ -69,6 +86,10 @@ def register_extensions(app):
     cors.init_app(app)
 
     assets_env.init_app(app)
+    register_assets()
+
+
+def register_assets():
     assets_loader = PythonAssetsLoader(assets)
     for name, bundle in assets_loader.load_bundles().items():
         assets_env.register(name, bundle)
@@ -107,37 +128,92 @@ def register_views(app):
             app.view_functions[endpoint_name] = login_required(view_func)
 
 
+def register_metrics(app):
+    metrics = RequestMetrics(app.wsgi_app,
+                             app.config.get('METRICS_PROFILE_RATE', 0.0),
+                             app.config.get('METRICS_PROFILE_HEADER', False))
+    app.wsgi_app = metrics
+    app.extensions['metrics'] = metrics
+
+    app.before_request(remember_endpoint)
+    if not event.contains(Engine, 'before_cursor_execute', count_query):
+        event.listen(Engine, 'before_cursor_execute', count_query)
+
+    def metrics_view():
+        queue_handler = app.extensions.get('log_queue_handler')
+        return jsonify(endpoints=metrics.snapshot(),
+                       dropped_log_records=queue_handler.dropped if queue_handler else 0)
+
+    # the same protection as for Swagger UI views
+    app.add_url_rule('/metrics', 'metrics', login_required(metrics_view))
+
+
 def register_context_processors(app):
     app.context_processor(users_helpers)
 
 
 def configure_celery(app):
     celery.conf.update(app.config['CELERY'])
+    # workers don't import the API controllers which queue these tasks
+    celery.conf.imports = tuple(celery.conf.imports or ()) + ('parcel_tasks',)
 
     TaskBase = celery.Task
+    # a prefork worker process keeps one app context for all its tasks
+    worker = {'context': None, 'depth': 0}
 
     class ContextTask(TaskBase):
         abstract = True
 
         def __call__(self, *args, **kwargs):
-            with app.app_context():
+            if worker['context'] is None:
+                with app.app_context():
+                    return TaskBase.__call__(self, *args, **kwargs)
+
+            worker['depth'] += 1
+            try:
                 return TaskBase.__call__(self, *args, **kwargs)
+            finally:
+                worker['depth'] -= 1
+                if not worker['depth']:
+                    # what popping the context would do, without creating a new one
+                    app.do_teardown_appcontext()
+                    g.__dict__.clear()
 
     celery.Task = ContextTask
 
+    def push_worker_context(**kwargs):
+        worker['context'] = app.app_context()
+        worker['context'].push()
+
+    worker_process_init.connect(push_worker_context, weak=False)
+    app.after_request(send_task_batches)
+
 
 def configure_logging(app):
     if not app.debug:
-        file_handler = RotatingFileHandler(app.config['LOG_FILE'], maxBytes=10000)
-        formatter = logging.Formatter(
-            "%(asctime)s %(levelname)s %(ip)s - %(uid)s - %(method)s %(url)s\n"
-            "%(pathname)s:%(lineno)d]: %(funcName)s |\n"
-            "%(message)s\n"
-            "-------------------------------------------------------------------------------\n"
-        )
+        file_handler = RotatingFileHandler(app.config['LOG_FILE'],
+                                           maxBytes=app.config.get('LOG_MAX_BYTES', 10 * 1024 * 1024),
+                                           backupCount=app.config.get('LOG_BACKUP_COUNT', 5))
+        if app.config.get('LOG_FORMAT') == 'json':
+            formatter = JSONFormatter()
+        else:
+            formatter = logging.Formatter(
+                "%(asctime)s %(levelname)s %(ip)s - %(uid)s - %(method)s %(url)s\n"
+                "%(pathname)s:%(lineno)d]: %(funcName)s |\n"
+                "%(message)s\n"
+                "-------------------------------------------------------------------------------\n"
+            )
         # file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(formatter)
-        app.logger.addHandler(file_handler)
+
+        # request threads only put records to the queue, the listener thread writes them to disk
+        queue_handler = DroppingQueueHandler([file_handler], app.config.get('LOG_QUEUE_SIZE', 10000))
+        atexit.register(queue_handler.stop)
+        app.extensions['log_queue_handler'] = queue_handler
+
+        if app.config.get('LOG_LEVEL'):
+            app.logger.setLevel(app.config['LOG_LEVEL'])
+        app.logger.addHandler(queue_handler)
         app.logger.addFilter(ContextualFilter())
 
 
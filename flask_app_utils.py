@@ -0,0 +1,199 @@
+import copy
+import cProfile
+import io
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import pstats
+import random
+from collections import defaultdict
+from queue import Full, Queue
+from threading import Lock
+from time import perf_counter
+
+from flask import current_app, g, request, has_request_context
+from werkzeug.wsgi import ClosingIterator
+
+
+class RequestMetrics(object):
+    """
+    WSGI middleware which collects per-endpoint latency histograms and SQL query counts.
+    A fraction of requests is run under cProfile; with profile_header=True
+    requests with X-Profile header are profiled as well.
+    Metrics are recorded when the response is closed, so streamed bodies are counted.
+    """
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, wsgi_app, profile_rate=0.0, profile_header=False):
+        self.wsgi_app = wsgi_app
+        self.profile_rate = profile_rate
+        self.profile_header = profile_header
+        self.lock = Lock()
+        self.latency = defaultdict(lambda: [0] * len(self.buckets))
+        self.requests = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.profiles = {}
+
+    def __call__(self, environ, start_response):
+        profiler = None
+        if (self.profile_header and environ.get('HTTP_X_PROFILE')) or random.random() < self.profile_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is active (only one is allowed since Python 3.12)
+                profiler = None
+
+        start = perf_counter()
+
+        def finish():
+            elapsed = perf_counter() - start
+            if profiler:
+                profiler.disable()
+            self.record(environ.get('k24.endpoint') or 'unknown', elapsed,
+                        environ.get('k24.queries', 0), profiler)
+
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(app_iter, finish)
+
+    def record(self, endpoint, elapsed, queries, profiler=None):
+        bucket = next(i for i, bound in enumerate(self.buckets) if elapsed <= bound)
+        with self.lock:
+            self.latency[endpoint][bucket] += 1
+            self.requests[endpoint] += 1
+            self.queries[endpoint] += queries
+
+        if profiler:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+            self.profiles[endpoint] = out.getvalue()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    'requests': count,
+                    'queries_per_request': self.queries[endpoint] / count,
+                    'latency': dict(zip(map(str, self.buckets), self.latency[endpoint])),
+                    'profile': self.profiles.get(endpoint),
+                }
+                for endpoint, count in self.requests.items()
+            }
+
+
+def remember_endpoint():
+    request.environ['k24.endpoint'] = request.endpoint
+
+
+def count_query(*args, **kwargs):
+    if has_request_context():
+        request.environ['k24.queries'] = request.environ.get('k24.queries', 0) + 1
+
+
+class JSONFormatter(logging.Formatter):
+    fields = ('levelname', 'ip', 'uid', 'method', 'url', 'pathname', 'lineno', 'funcName')
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'message': record.getMessage()}
+        for field in self.fields:
+            data[field] = getattr(record, field, None)
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class DrainingQueueListener(QueueListener):
+    """Waits for room in a full queue on stop, so the records are written before exit"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records to a bounded queue, a listener thread writes them with the target handlers.
+    Drops records instead of blocking the request when the writer falls behind
+    and logs how many were dropped once the queue has room again.
+    The listener is started by the first record of every process:
+    forked workers don't inherit the listener thread of the parent.
+    """
+
+    def __init__(self, target_handlers, maxsize=10000):
+        super().__init__(None)
+        self.target_handlers = target_handlers
+        self.maxsize = maxsize
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self.reported = 0
+
+    def start(self):
+        self.queue = Queue(maxsize=self.maxsize)
+        self.listener = DrainingQueueListener(self.queue, *self.target_handlers)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        if self.listener and self.pid == os.getpid():
+            self.listener.stop()
+
+    def prepare(self, record):
+        # formatting is left to the listener thread, only the message is resolved here:
+        # args may be mutated by the request thread after the record is queued
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # emit() is called under the handler lock, so the listener is started once
+        if self.pid != os.getpid():
+            self.start()
+
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return
+
+        if self.dropped > self.reported:
+            # a copy keeps the contextual fields the formatter expects
+            warning = copy.copy(record)
+            warning.levelno, warning.levelname = logging.WARNING, 'WARNING'
+            warning.msg = '{} log records dropped, the log writer falls behind'.format(
+                self.dropped - self.reported)
+            warning.exc_info = warning.exc_text = None
+            try:
+                self.queue.put_nowait(warning)
+                self.reported = self.dropped
+            except Full:
+                pass
+
+
+def defer_task(task, *args):
+    """
+    Merges tiny tasks (notifications, status updates) sent during a request:
+    they are sent after the request in chunks of TASK_BATCH_SIZE calls,
+    and every chunk runs as one task execution.
+    Outside of a request the task is sent at once.
+    """
+    if not has_request_context():
+        return task.delay(*args)
+
+    if 'task_batches' not in g:
+        g.task_batches = {}
+    g.task_batches.setdefault(task.name, (task, []))[1].append(args)
+
+
+def send_task_batches(response):
+    for task, calls in g.pop('task_batches', {}).values():
+        if len(calls) == 1:
+            task.delay(*calls[0])
+        else:
+            task.chunks(calls, current_app.config.get('TASK_BATCH_SIZE', 100)).apply_async()
+    return response
@@ -1,5 +1,6 @@
 import base64
 import dicttoxml
+import logging
 import subprocess
 from datetime import datetime
 from flask import jsonify, request, current_app as app
@@ -12,6 +13,7 @@ from app.models.cellsize import CellSize
 from app.controllers.api.parcel import create_one
 from app.models.parcel.utils import act_pp
 from app.utils.NotifyManager import send_message
+from parcel_tasks import make_barcode
 
 
 class ServiceResponse:
@@ -25,7 +27,7 @@ class ServiceResponse:
 
     @classmethod
     def success_response(cls, email=0, acts64=None, label64=None,
-                         zip64=None, packcodes=None):
+                         zip64=None, packcodes=None, merged64=None):
         data = dict(
             result=1,
             email=email,
@@ -35,23 +37,28 @@ class ServiceResponse:
             zip=zip64.decode('ascii') if zip64 else '',
             packcodes=packcodes
         )
-        app.logger.debug('Success: {}'.format(data))
+        if merged64:
+            # merge=1 only, label and confirmprintout keep their meaning
+            data['merged'] = merged64.decode('ascii')
+        app.logger.debug('Success: %s', data)
         return cls.response_json(**data)
 
 
 class CreateDeliveryPacks(object):
     sender = None
-    files = set()
-    labels64 = []
-    acts64 = []
 
     def __init__(self, data):
         self.data = data
+        # per request state, must not be shared between instances
+        self.files = set()
+        self.labels64 = []
+        self.acts64 = []
+        self.pages = []
         self._authenticate_sender()
 
-    def log(self, msg=None, error=None):
-        if msg and app.config.get('DEBUG'):
-            app.logger.debug(msg)
+    def log(self, msg=None, *args, error=None):
+        if msg and app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug(msg, *args)
         elif error:
             app.logger.error(error)
 
@@ -68,8 +75,8 @@ class CreateDeliveryPacks(object):
         if self.sender is None:
             raise self.Unauthorized('Authentication failed')
 
-    def create_parcel(self, data):
-        self.log(msg=data)
+    def create_parcel(self, data, render_barcode=True):
+        self.log('%s', data)
         rec_phone, rec_email, box_, cellsize, amount, barcode, comment = data
         box = Box.filter_by(code=box_).first()
         if box is None:
@@ -97,7 +104,12 @@ class CreateDeliveryPacks(object):
             comment=comment
         ))
         # FNR11-3.6
-        parcel.make_barcode(bc=barcode)
+        # the image is needed right away only for stickers and acts,
+        # otherwise it is rendered by a worker
+        if render_barcode or not barcode:
+            parcel.make_barcode(bc=barcode)
+        else:
+            make_barcode.delay(parcel.id, barcode)
 
         documents = {}
         # FNR11-3.9
@@ -145,6 +157,29 @@ class CreateDeliveryPacks(object):
             raise Error('Ошибка формирования Акта-ПП для посылки: {}'
                         ''.format(parcel.barcode))
 
+    def get_merged_pdf(self):
+        """
+        Merges collected stickers and acts into one multi-page PDF.
+        Printers handle one document much faster than hundreds of small ones.
+        :return: base64 of the merged PDF
+        """
+        fn = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        pdf_path = '/tmp/{}-labels.pdf'.format(fn)
+        args = ['pdfunite']
+        args.extend(self.pages)
+        args.append(pdf_path)
+        try:
+            returncode = subprocess.Popen(args).wait()
+        except OSError as e:
+            # pdfunite comes with poppler-utils
+            self.log(error='pdfunite failed: {}'.format(e))
+            raise Error('Ошибка печати этикеток')
+        if returncode != 0:
+            raise Error('Ошибка печати этикеток')
+        self.files.add(pdf_path)
+        with open(pdf_path, 'rb') as pdf_file:
+            return base64.b64encode(pdf_file.read())
+
     def get_zip(self, parcel, shipment, return_path=False):
         label_path, label_data64 = self.get_label(
             parcel, return_path=True, b64=True)
@@ -160,7 +195,7 @@ class CreateDeliveryPacks(object):
 
     def main(self):
         data = self.data
-        self.log(msg='parcel.createdeliverypacks({})'.format(data))
+        self.log('parcel.createdeliverypacks(%s)', data)
 
         parcels = data['parcels']
         email = data.get('email')
@@ -168,6 +203,7 @@ class CreateDeliveryPacks(object):
         confirmprintout = str(data.get('confirmprintout')) == '1'
         gz = str(data.get('zip')) == '1'
         packcodes = str(data.get('packcodes')) == '1'
+        merge = str(data.get('merge')) == '1'
         response_format = data.get('type')
         test = data.get('test')
 
@@ -181,18 +217,27 @@ class CreateDeliveryPacks(object):
             app.logger.error('Empty parcels list: {}'.format(data['parcels']))
             return ServiceResponse.error_response('Не передан список посылок!')
 
-        app.logger.debug('Parcels: {}'.format(parcels))
+        app.logger.debug('Parcels: %s', parcels)
 
         for parcel_data in parcels:
             if not parcel_data:
                 continue
             try:
-                parcel, shipment = self.create_parcel(parcel_data.split(';'))
+                parcel, shipment = self.create_parcel(
+                    parcel_data.split(';'),
+                    render_barcode=label or confirmprintout or gz or bool(email))
                 if packcodes:
                     packcodes_list.append(parcel.barcode)
                 if gz or email:
                     to_zip.append(self.get_zip(parcel, shipment,
                                                return_path=True))
+                elif merge:
+                    if label:
+                        path, _ = self.get_label(parcel, return_path=True)
+                        self.pages.append(path)
+                    if confirmprintout:
+                        path, _ = self.get_act_pp(parcel, shipment)
+                        self.pages.append(path)
                 else:
                     if label:
                         self.get_label(parcel, b64=True)
@@ -208,16 +253,20 @@ class CreateDeliveryPacks(object):
         )
         if packcodes:
             kwargs['packcodes'] = packcodes_list
-        if label:
-            kwargs['label64'] = self.labels64
-        if confirmprintout:
-            kwargs['acts64'] = self.acts64
+        if merge and self.pages:
+            # labels and acts (if requested) are pages of the same document
+            kwargs['merged64'] = self.get_merged_pdf()
+        else:
+            if label:
+                kwargs['label64'] = self.labels64
+            if confirmprintout:
+                kwargs['acts64'] = self.acts64
         if self.files and email:
             fn = datetime.now().strftime('%Y%m%d%H%M%S')
             zip_path = '/tmp/{}.zip'.format(fn)
             args = ['zip', zip_path, '-j']
             args.extend(self.files)
-            self.log(msg=' '.join(args))
+            self.log('%s', ' '.join(args))
             subprocess.Popen(args).wait()
             with open(zip_path, 'rb') as zip_file:
                 kwargs['zip64'] = base64.b64encode(zip_file.read())
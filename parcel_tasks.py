@@ -0,0 +1,16 @@
+from app.extensions import celery
+from app.models.parcel import Parcel
+
+
+class ParcelNotFound(Exception):
+    pass
+
+
+@celery.task(bind=True, ignore_result=True, max_retries=5, default_retry_delay=10)
+def make_barcode(self, parcel_id, barcode):
+    """Renders the barcode of a parcel created without a label"""
+    parcel = Parcel.query.get(parcel_id)
+    if parcel is None:
+        # the request which has created the parcel may not be committed yet
+        raise self.retry(exc=ParcelNotFound(parcel_id))
+    parcel.make_barcode(bc=barcode)
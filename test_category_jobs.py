@@ -0,0 +1,154 @@
+import io
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from mock import patch, MagicMock
+from pymongo.errors import DuplicateKeyError
+from werkzeug.exceptions import NotFound
+
+import category_jobs
+
+
+@pytest.fixture
+def app(tmpdir):
+    app = Flask(__name__)
+    app.config.update(SCRAPE_JOB_TIMEOUT=timedelta(hours=2), SCRAPE_QUEUE_TIMEOUT=timedelta(minutes=10),
+                      EXPORT_DIR=str(tmpdir), EXPORT_GRACE=timedelta(minutes=1))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def db(app):
+    with patch('category_jobs.db') as db:
+        db.categories.find_one.return_value = {'_id': 'child', 'path': ',root,'}
+        db.jobs.find_one.return_value = None
+        db.scrape_requests.find.return_value = []
+        db.scrape_requests.find_one.return_value = None
+        db.scrape_requests.update.return_value = {'n': 1}
+        yield db
+
+
+def test_scrape_claims_a_new_category(db):
+    assert category_jobs.coalesce_scrape('child') is None
+
+    assert db.scrape_requests.insert.call_args[0][0]['_id'] == 'child'
+
+
+def test_scrape_coalesces_with_an_ancestor_job(db):
+    db.jobs.find_one.return_value = {'_id': 'job-1'}
+
+    assert category_jobs.coalesce_scrape('child') == 'job-1'
+
+    query = db.jobs.find_one.call_args[0][0]
+    assert set(query['category']['$in']) == {'child', 'root'}
+    # stale unfinished jobs don't block new scrapes
+    assert '$gt' in query['_id']
+    assert not db.scrape_requests.insert.called
+
+
+def test_scrape_coalesces_with_a_queued_ancestor(db):
+    """A click made before tasks.scrape has written its job"""
+    db.scrape_requests.find.return_value = [{'_id': 'root', 'created': datetime.utcnow()}]
+
+    assert category_jobs.coalesce_scrape('child') == 'root'
+    assert not db.scrape_requests.insert.called
+
+
+def test_scrape_loses_a_concurrent_insert(db):
+    db.scrape_requests.insert.side_effect = DuplicateKeyError('E11000')
+
+    assert category_jobs.coalesce_scrape('child') == 'child'
+
+
+def test_scrape_coalesces_with_a_queued_request(db):
+    db.scrape_requests.find_one.return_value = {'_id': 'child', 'created': datetime.utcnow()}
+
+    assert category_jobs.coalesce_scrape('child') == 'child'
+    assert not db.scrape_requests.update.called
+
+
+def test_scrape_reclaims_a_request_which_already_has_a_job(db):
+    created = datetime.utcnow()
+    db.scrape_requests.find_one.return_value = {'_id': 'child', 'created': created}
+    # the first call looks for active jobs, the second one for the job of the queued request
+    db.jobs.find_one.side_effect = [None, {'_id': 'job-1', 'status': 'finished'}]
+
+    assert category_jobs.coalesce_scrape('child') is None
+
+    query = db.scrape_requests.update.call_args[0][0]
+    assert query == {'_id': 'child', 'created': created}
+
+
+def test_scrape_reclaims_an_expired_request(db):
+    db.scrape_requests.find_one.return_value = {'_id': 'child', 'created': datetime.utcnow() - timedelta(hours=1)}
+
+    assert category_jobs.coalesce_scrape('child') is None
+
+
+def test_scrape_loses_a_concurrent_reclaim(db):
+    db.scrape_requests.find_one.return_value = {'_id': 'child', 'created': datetime.utcnow() - timedelta(hours=1)}
+    db.scrape_requests.update.return_value = {'n': 0}
+
+    assert category_jobs.coalesce_scrape('child') == 'child'
+
+
+@pytest.fixture
+def csv_export(db):
+    db.categories.find.return_value = []
+    db.jobs.find.return_value = [{'_id': 'job-1'}]
+    build = MagicMock(side_effect=lambda cid, f: io.BytesIO(b'name,price\nthing,$1\n'))
+    with patch.dict('category_jobs.EXPORTS', {'csv': (build, '{}.csv', 'text/csv')}):
+        yield build
+
+
+def test_export_is_built_once_per_scrape_job(app, db, csv_export):
+    with app.test_request_context():
+        resp = category_jobs.export_response('child', 'csv')
+        resp.direct_passthrough = False
+        assert resp.status_code == 200
+        assert resp.get_data() == b'name,price\nthing,$1\n'
+        category_jobs.export_response('child', 'csv').close()
+        assert csv_export.call_count == 1
+
+        db.jobs.find.return_value = [{'_id': 'job-1'}, {'_id': 'job-2'}]
+        category_jobs.export_response('child', 'csv').close()
+        assert csv_export.call_count == 2
+        resp.close()
+
+
+def test_export_supports_range_requests(app, db, csv_export):
+    with app.test_request_context(headers={'Range': 'bytes=0-3'}):
+        resp = category_jobs.export_response('child', 'csv')
+        resp.direct_passthrough = False
+
+        assert resp.status_code == 206
+        assert resp.get_data() == b'name'
+        resp.close()
+
+
+@pytest.mark.parametrize('cid', ['missing', '..'])
+def test_export_of_an_unknown_category_is_not_found(app, db, csv_export, cid):
+    db.categories.find_one.return_value = None
+
+    with app.test_request_context(), pytest.raises(NotFound):
+        category_jobs.export_response(cid, 'csv')
+    assert not csv_export.called
+    assert os.listdir(app.config['EXPORT_DIR']) == []
+
+
+def test_superseded_export_is_kept_for_the_grace_period(app, db, csv_export):
+    category = {'_id': 'child', 'path': ',root,'}
+    first = category_jobs.build_export(category, 'csv', 'v1')
+    time.sleep(0.002)
+    category_jobs.build_export(category, 'csv', 'v2')
+    assert os.path.exists(first)
+
+    app.config['EXPORT_GRACE'] = timedelta(0)
+    time.sleep(0.002)
+    latest = category_jobs.build_export(category, 'csv', 'v3')
+    assert not os.path.exists(first)
+    assert sorted(os.listdir(os.path.dirname(latest)))[-1] == os.path.basename(latest)
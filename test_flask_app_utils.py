@@ -0,0 +1,207 @@
+import pytest
+from mock import MagicMock
+
+
+def simple_app(body=(b'OK',), queries=0):
+    def wsgi_app(environ, start_response):
+        environ['k24.endpoint'] = 'index'
+        environ['k24.queries'] = queries
+        start_response('200 OK', [])
+        return list(body)
+    return wsgi_app
+
+
+def call(middleware, **environ):
+    start_response = MagicMock()
+    app_iter = middleware(dict(environ), start_response)
+    body = b''.join(app_iter)
+    app_iter.close()
+    return body
+
+
+def test_request_metrics_record_and_snapshot():
+    from flask_app_utils import RequestMetrics
+
+    metrics = RequestMetrics(None)
+    metrics.record('index', 0.02, 3)
+    metrics.record('index', 3.0, 1)
+    metrics.record('other', 20.0, 0)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['index']['requests'] == 2
+    assert snapshot['index']['queries_per_request'] == 2
+    assert snapshot['index']['latency']['0.05'] == 1
+    assert snapshot['index']['latency']['5'] == 1
+    assert snapshot['other']['latency']['inf'] == 1
+    assert snapshot['index']['profile'] is None
+
+
+def test_request_metrics_are_recorded_when_response_is_closed():
+    from flask_app_utils import RequestMetrics
+
+    metrics = RequestMetrics(simple_app(queries=2))
+    app_iter = metrics({}, MagicMock())
+    assert metrics.snapshot() == {}
+
+    app_iter.close()
+    snapshot = metrics.snapshot()
+    assert snapshot['index']['requests'] == 1
+    assert snapshot['index']['queries_per_request'] == 2
+
+
+@pytest.mark.parametrize('profile_header, profiled', [(False, False), (True, True)])
+def test_profile_header_is_honoured_only_when_enabled(profile_header, profiled):
+    from flask_app_utils import RequestMetrics
+
+    metrics = RequestMetrics(simple_app(), profile_header=profile_header)
+    assert call(metrics, HTTP_X_PROFILE='1') == b'OK'
+
+    assert (metrics.snapshot()['index']['profile'] is not None) == profiled
+
+
+def make_record(msg='hello %s', args=('world',), exc_info=None, **extra):
+    import logging
+    record = logging.LogRecord('app', logging.ERROR, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+class BlockingHandler(object):
+    """Target handler which keeps the listener busy until released"""
+
+    def __init__(self):
+        import threading
+        self.released = threading.Event()
+        self.records = []
+
+    def handle(self, record):
+        self.released.wait(5)
+        self.records.append(record)
+
+
+def test_dropping_queue_handler_drops_records_when_writer_falls_behind():
+    from flask_app_utils import DroppingQueueHandler
+
+    target = BlockingHandler()
+    handler = DroppingQueueHandler([target], maxsize=2)
+    for _ in range(10):
+        handler.handle(make_record())
+
+    # two records are queued, one may be held by the listener already
+    assert handler.dropped in (7, 8)
+    dropped = handler.dropped
+
+    target.released.set()
+    handler.queue.join()
+
+    handler.handle(make_record(msg='after', args=()))
+    handler.stop()
+
+    messages = [r.msg for r in target.records]
+    assert messages[-2:] == ['after', '{} log records dropped, the log writer falls behind'.format(dropped)]
+    assert target.records[-1].levelname == 'WARNING'
+
+
+def test_dropping_queue_handler_starts_listener_in_every_process():
+    import os
+    from flask_app_utils import DroppingQueueHandler
+
+    target = BlockingHandler()
+    target.released.set()
+    handler = DroppingQueueHandler([target])
+    assert handler.listener is None
+
+    handler.handle(make_record())
+    parent_queue = handler.queue
+    assert handler.pid == os.getpid()
+
+    # what a forked child sees: the pid changed, the listener thread is gone
+    handler.pid = -1
+    handler.handle(make_record())
+    handler.stop()
+
+    assert handler.queue is not parent_queue
+    assert len(target.records) == 2
+
+
+def test_dropping_queue_handler_leaves_formatting_to_listener():
+    import sys
+    from flask_app_utils import DroppingQueueHandler
+
+    try:
+        raise ValueError('OMG!')
+    except ValueError:
+        record = make_record(exc_info=sys.exc_info())
+
+    prepared = DroppingQueueHandler([]).prepare(record)
+
+    assert prepared.msg == 'hello world'
+    assert prepared.args is None
+    assert prepared.exc_info is not None
+
+
+def test_json_formatter():
+    import json
+    import sys
+    from flask_app_utils import JSONFormatter
+
+    try:
+        raise ValueError('OMG!')
+    except ValueError:
+        record = make_record(exc_info=sys.exc_info(), ip='127.0.0.1', url='/api')
+
+    data = json.loads(JSONFormatter().format(record))
+
+    assert data['message'] == 'hello world'
+    assert data['levelname'] == 'ERROR'
+    assert data['ip'] == '127.0.0.1'
+    assert data['url'] == '/api'
+    assert data['uid'] is None
+    assert 'ValueError: OMG!' in data['exc']
+
+
+@pytest.fixture
+def notify_task():
+    task = MagicMock()
+    task.name = 'notify'
+    return task
+
+
+def test_defer_task_sends_chunks_after_request(notify_task):
+    from flask import Flask
+    from flask_app_utils import defer_task, send_task_batches
+
+    app = Flask(__name__)
+    app.config['TASK_BATCH_SIZE'] = 10
+    response = MagicMock()
+
+    with app.test_request_context():
+        for i in range(25):
+            defer_task(notify_task, i, 'sent')
+        assert not notify_task.delay.called
+        assert not notify_task.chunks.called
+
+        assert send_task_batches(response) is response
+
+    notify_task.chunks.assert_called_once_with([(i, 'sent') for i in range(25)], 10)
+    notify_task.chunks.return_value.apply_async.assert_called_once_with()
+
+
+def test_defer_task_single_call_is_sent_as_is(notify_task):
+    from flask import Flask
+    from flask_app_utils import defer_task, send_task_batches
+
+    with Flask(__name__).test_request_context():
+        defer_task(notify_task, 1)
+        send_task_batches(MagicMock())
+
+    notify_task.delay.assert_called_once_with(1)
+    assert not notify_task.chunks.called
+
+
+def test_defer_task_outside_request(notify_task):
+    from flask_app_utils import defer_task
+
+    defer_task(notify_task, 1)
+
+    notify_task.delay.assert_called_once_with(1)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import pytest
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from model_mommy import mommy
+
+
+def make_manager(client):
+    user = mommy.make('User', username='manager')
+    user.groups.add(mommy.make('Group', name=u'Менеджеры'))
+    client.force_login(user)
+    return user
+
+def make_driver():
+    profile = mommy.make('driver.Profile', _fill_optional=['phone', 'passport'])
+    return mommy.make('driver.Driver', profile=profile, _fill_optional=['car', 'tablet'])
+
+def count_list_queries(client, **params):
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get(reverse('list_drivers'), params)
+    assert resp.status_code == 200
+    return len(queries)
+
+
+@pytest.mark.django_db
+def test_list_drivers_query_count_does_not_grow(client):
+    """Phone, passport, driver, car and tablet are loaded with profiles"""
+    make_manager(client)
+    make_driver()
+
+    # warm up the session and the groups cache
+    client.get(reverse('list_drivers'))
+    one_driver = count_list_queries(client)
+
+    for _ in range(10):
+        make_driver()
+
+    assert count_list_queries(client) == one_driver
+
+
+@pytest.mark.django_db
+def test_list_drivers_keyset_pagination(client):
+    make_manager(client)
+    drivers = [make_driver() for _ in range(3)]
+
+    resp = client.get(reverse('list_drivers'))
+    assert len(resp.context['profiles']) == 3
+
+    resp = client.get(reverse('list_drivers'), {'per_page': 2})
+    assert [p.pk for p in resp.context['profiles']] == [d.profile.pk for d in drivers[:2]]
+    assert resp.context['next_after'] == drivers[1].profile.pk
+
+    resp = client.get(reverse('list_drivers'), {'per_page': 2, 'after': drivers[1].profile.pk})
+    assert [p.pk for p in resp.context['profiles']] == [drivers[2].profile.pk]
+    assert resp.context['next_after'] is None
+
+
+@pytest.fixture
+def empty_cache():
+    from django.core.cache import cache
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_group_required_caches_user_groups(client, empty_cache):
+    from driver.views import user_groups_key
+
+    user = make_manager(client)
+
+    assert client.get(reverse('list_drivers')).status_code == 200
+    assert empty_cache.get(user_groups_key(user.pk)) == frozenset([u'Менеджеры'])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_group_required_cache_is_reset_when_groups_change(client, empty_cache):
+    """transaction=True, as the cache is reset on commit"""
+    user = make_manager(client)
+    group = user.groups.get()
+    assert client.get(reverse('list_drivers')).status_code == 200
+
+    user.groups.clear()
+    assert client.get(reverse('list_drivers')).status_code == 403
+
+    group.user_set.add(user)
+    assert client.get(reverse('list_drivers')).status_code == 200
+
+    group.user_set.remove(user)
+    assert client.get(reverse('list_drivers')).status_code == 403
+
+
+@pytest.mark.django_db
+def test_add_driver_invalid_submit_saves_nothing(client):
+    from driver.models import Phone
+
+    make_manager(client)
+
+    resp = client.post(reverse('add_driver'), {'phone-number': '+79161234567'})
+
+    assert resp.status_code == 200
+    assert resp.context['phone_form'].is_valid()
+    assert not resp.context['profile_form'].is_valid()
+    assert Phone.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_edit_driver_invalid_submit_keeps_tablet(client):
+    from driver.models import Driver
+
+    make_manager(client)
+    driver = make_driver()
+
+    # no tablet-our_tablet: the tablet is deleted before the forms are validated
+    resp = client.post(reverse('edit_driver', args=[driver.profile.pk]), {})
+
+    assert resp.status_code == 200
+    assert Driver.objects.get(pk=driver.pk).tablet_id == driver.tablet_id
@@ -2,6 +2,10 @@
 from functools import wraps
 
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, pre_delete
 from django.http import HttpResponse, HttpResponseRedirect, Http404, HttpResponseForbidden
 from django.shortcuts import render, render_to_response, redirect, get_object_or_404
 
@@ -10,6 +14,12 @@ from driver.forms import (ProfileForm, ProfileMetaForm, PhoneForm, PhoneFormset,
                           DriverForm, PassportForm, TabletForm)
 
 
+MAX_DRIVERS_PER_PAGE = 1000
+# limits the damage of a missed invalidation. With a per-process cache backend (locmem)
+# signals clear only the local copy, other processes keep a revoked group up to this long
+USER_GROUPS_TIMEOUT = 5 * 60
+
+
 def render_with_rc(template_name):
     """Renders view with RequestContext"""
     def decorator(view_func):
@@ -23,7 +33,56 @@ def render_with_rc(template_name):
         return new_view_func
     return decorator
 
+def user_groups_key(user_id):
+    return 'user_groups:{}'.format(user_id)
+
+def user_groups(user):
+    """Returns names of user groups, cached until the membership changes"""
+    key = user_groups_key(user.pk)
+    groups = cache.get(key)
+    if groups is None:
+        groups = frozenset(user.groups.values_list('name', flat=True))
+        cache.set(key, groups, USER_GROUPS_TIMEOUT)
+    return groups
+
+def forget_user_groups(user_ids):
+    """
+    Drops cached groups once the transaction is committed,
+    otherwise a concurrent request could cache the old groups again
+    """
+    keys = [user_groups_key(pk) for pk in user_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+def reset_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    # on clear pk_set is None, so reverse clear needs the users before they are gone
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if not reverse:
+        forget_user_groups([instance.pk])
+    elif pk_set is not None:
+        # instance is a Group, pk_set holds users
+        forget_user_groups(pk_set)
+    elif action == 'pre_clear':
+        forget_user_groups(list(instance.user_set.values_list('pk', flat=True)))
+
+def reset_group_users(sender, instance, **kwargs):
+    forget_user_groups(list(instance.user_set.values_list('pk', flat=True)))
+
+def connect_group_signals():
+    """Called from DriverConfig.ready(), so it works in shells and commands too, and on import below"""
+    m2m_changed.connect(reset_user_groups, sender=User.groups.through,
+                        dispatch_uid='driver.reset_user_groups')
+    post_save.connect(reset_group_users, sender=Group, dispatch_uid='driver.reset_group_users.save')
+    pre_delete.connect(reset_group_users, sender=Group, dispatch_uid='driver.reset_group_users.delete')
+
+# Django < 2.0 runs DriverConfig.ready() only for 'driver.apps.DriverConfig' in INSTALLED_APPS
+# or with default_app_config, the views are imported anyway; dispatch_uid prevents double connection
+connect_group_signals()
+
 def group_required(*allowed_groups, **options):
+    allowed = frozenset(allowed_groups)
+
     def decorator(view_func):
         @wraps(view_func)
         def new_view_func(request, *args, **kwargs):
@@ -33,9 +92,8 @@ def group_required(*allowed_groups, **options):
             if options.get('admin', True) and request.user.is_superuser:
                 return view_func(request, *args, **kwargs)
 
-            for group_name in request.user.groups.values_list('name', flat=True):
-                if group_name in allowed_groups:
-                    return view_func(request, *args, **kwargs)
+            if user_groups(request.user) & allowed:
+                return view_func(request, *args, **kwargs)
 
             return HttpResponseForbidden(u'Эта часть сайта недоступна для вас')
         return new_view_func
@@ -46,11 +104,34 @@ def group_required(*allowed_groups, **options):
 @group_required(u'Менеджеры')
 @render_with_rc('driver/list.html')
 def list_drivers(request):
-    return {'profiles': Profile.objects.all()}
+    """
+    All drivers by default.
+    ?per_page=N[&after=<last profile id on the previous page>] pages by key
+    """
+    profiles = (Profile.objects
+                .select_related('phone', 'passport', 'driver__car', 'driver__tablet')
+                .order_by('pk'))
+
+    per_page = request.GET.get('per_page', '')
+    if not per_page.isdigit():
+        return {'profiles': profiles}
+
+    per_page = min(max(int(per_page), 1), MAX_DRIVERS_PER_PAGE)
+    after = request.GET.get('after', '')
+    if after.isdigit():
+        profiles = profiles.filter(pk__gt=int(after))
+
+    profiles = list(profiles[:per_page + 1])
+    has_next = len(profiles) > per_page
+    profiles = profiles[:per_page]
+
+    return {'profiles': profiles,
+            'next_after': profiles[-1].pk if has_next else None}
 
 @login_required
 @group_required(u'Менеджеры')
 @render_with_rc('driver/add.html')
+@transaction.atomic
 def add_driver(request):
     data = request.POST if request.method == 'POST' else None
 
@@ -96,6 +177,9 @@ def add_driver(request):
 
             return redirect('list_drivers')
 
+        # nothing of an invalid submit (e.g. the phone saved above) should stay in the db
+        transaction.set_rollback(True)
+
     return {'profile_form': profile_form,
             'phone_form': phone_form,
             'passport_form': passport_form,
@@ -106,6 +190,7 @@ def add_driver(request):
 @login_required
 @group_required(u'Менеджеры')
 @render_with_rc('driver/add.html')
+@transaction.atomic
 def edit_driver(request, profile_id):
     def look_for_driver_data():
         have_driver_data = driver_form.has_changed() or car_form.has_changed() or tablet_form.has_changed()
@@ -120,11 +205,10 @@ def edit_driver(request, profile_id):
 
     def sync_phone_with_user():
         phone.confirmed = False
-        phone.save()
 
         phone.user.username = phone.number
         phone.user.set_unusable_password()
-        phone.user.save()
+        phone.user.save(update_fields=['username', 'password'])
 
     data = request.POST if request.method == 'POST' else None
 
@@ -138,9 +222,10 @@ def edit_driver(request, profile_id):
     phone_form = PhoneForm(data, instance=phone, empty_permitted=True)
 
     if phone_form.is_valid() and phone_form.has_changed():
-        phone = phone_form.save()
+        phone = phone_form.save(commit=False)
         if phone.user and phone.number != phone.user.username:
             sync_phone_with_user()
+        phone.save()
 
     # передадим в profile_form id телефона для поля Profile.phone
     if phone and data:
@@ -167,16 +252,20 @@ def edit_driver(request, profile_id):
            driver_form.is_valid() and car_form.is_valid() and\
            tablet_form.is_valid() and passport_form.is_valid():
 
-            profile = profile_form.save()
+            profile = profile_form.save(commit=False)
 
             if passport_form.has_changed():
                 profile.passport = passport_form.save()
+
+            if profile_form.has_changed() or passport_form.has_changed():
                 profile.save()
+                profile_form.save_m2m()
 
             if have_driver_data:
                 driver = driver_form.save(commit=False)
                 driver.profile = profile
-                driver.car = car_form.save()
+                if car_form.has_changed() or not car_form.instance.pk:
+                    driver.car = car_form.save()
 
                 if tablet_form.has_changed():
                     driver.tablet = tablet_form.save()
@@ -185,6 +274,8 @@ def edit_driver(request, profile_id):
 
             return redirect('list_drivers')
 
+        transaction.set_rollback(True)
+
     return {'profile_form': profile_form,
             'phone_form': phone_form,
             'passport_form': passport_form,
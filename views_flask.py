@@ -1,14 +1,31 @@
 # -*- coding: utf-8 -*-
+import os
 import tempfile
-from flask import Flask, render_template, jsonify, Response, make_response
+from datetime import timedelta
+from flask import Flask, render_template, jsonify, make_response, request
 
+from category_jobs import coalesce_scrape, export_response
 from scraping import list_jobs
-from storage import db, category_as_csv, category_images_as_zip
+from storage import db
 
 from . import tasks
 
 
 app = Flask(__name__)
+app.config.setdefault('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'exports'))
+# how long a superseded export is kept for requests which have resolved it but not opened yet
+app.config.setdefault('EXPORT_GRACE', timedelta(minutes=1))
+# an unfinished job older than this is considered dead and doesn't block new scrapes
+app.config.setdefault('SCRAPE_JOB_TIMEOUT', timedelta(hours=2))
+# how long a queued scrape blocks duplicates until tasks.scrape writes its job
+app.config.setdefault('SCRAPE_QUEUE_TIMEOUT', timedelta(minutes=10))
+
+@app.before_first_request
+def ensure_indexes():
+    db.jobs.ensure_index('status')
+    db.jobs.ensure_index([('category', 1), ('status', 1)])
+    db.scrape_requests.ensure_index('created',
+                                    expireAfterSeconds=int(app.config['SCRAPE_QUEUE_TIMEOUT'].total_seconds()))
 
 
 @app.route('/')
@@ -38,7 +55,15 @@ def product_list(category_node):
 
 @app.route('/scrape/<category_node>')
 def scrape(category_node):
-    tasks.scrape.delay(category_node)
+    coalesced_with = coalesce_scrape(category_node)
+    if coalesced_with:
+        return jsonify(coalesced_with=coalesced_with)
+
+    priority = request.args.get('priority', type=int)
+    if priority is None:
+        tasks.scrape.delay(category_node)
+    else:
+        tasks.scrape.apply_async((category_node,), priority=priority)
     return jsonify({})
 
 
@@ -70,13 +95,9 @@ def delete_jobs():
 
 @app.route('/export/csv/<cid>')
 def csv(cid):
-    return Response(category_as_csv(cid, tempfile.TemporaryFile()),
-                    mimetype='text/csv',
-                    headers={"Content-Disposition": "attachment;filename={}.csv".format(cid)})
+    return export_response(cid, 'csv')
 
 
 @app.route('/export/images/<cid>')
 def zip(cid):
-    return Response(category_images_as_zip(cid, tempfile.TemporaryFile()),
-                    mimetype='application/zip',
-                    headers={"Content-Disposition": "attachment;filename={}-images.zip".format(cid)})
+    return export_response(cid, 'images')